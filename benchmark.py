@@ -0,0 +1,67 @@
+"""Measure the per-request memory of the quality mode document pipeline.
+
+Runs crawl ingest, text splitting and merging on synthetic pages, without the
+search engine, crawler or embedding model, and reports the memory allocated per request.
+
+    python benchmark.py --pages 30 --page-chars 200000
+"""
+import argparse
+import random
+import tracemalloc
+from typing import List
+
+from config import MAX_PAGE_CHARS
+from retriever import expand_docs_by_text_split, merge_docs_by_url
+from utils import Document
+
+
+def make_page(num_chars: int) -> str:
+    words = ["英伟达", "股价", "market", "earnings", "半导体", "guidance", "芯片", "revenue"]
+    lines = []
+    size = 0
+    while size < num_chars:
+        line = " ".join(random.choices(words, k=random.randint(5, 40)))
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def run_request(pages: List[str], num_relevant: int) -> list:
+    docs = [Document(title=f"page {i}", url=f"https://example.com/{i}", snippet=page[:200])
+            for i, page in enumerate(pages)]
+    # what Crawler.crawl_many does on success
+    for doc, page in zip(docs, pages):
+        doc.content = page[:MAX_PAGE_CHARS]
+
+    chunks = expand_docs_by_text_split(docs)
+    # stand-in for the retriever: keep a random subset of the chunks
+    relevant = random.sample(chunks, min(num_relevant, len(chunks)))
+    merged = merge_docs_by_url(relevant)
+    # the prompt is built from the merged content
+    prompt_chars = sum(len(doc.content) for doc in merged)
+    return [docs, chunks, merged, prompt_chars]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=30, help="number of crawled pages per request")
+    parser.add_argument("--page-chars", type=int, default=200000, help="size of each raw crawled page")
+    parser.add_argument("--relevant", type=int, default=40, help="number of chunks kept by the retriever")
+    parser.add_argument("--requests", type=int, default=5, help="number of requests to measure")
+    args = parser.parse_args()
+
+    random.seed(0)
+    pages = [make_page(args.page_chars) for _ in range(args.pages)]
+
+    print(f"{args.pages} pages x {args.page_chars} chars, MAX_PAGE_CHARS={MAX_PAGE_CHARS}")
+    for i in range(args.requests):
+        tracemalloc.start()
+        result = run_request(pages, args.relevant)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"request {i+1}: {len(result[1])} chunks, "
+              f"retained {retained / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,19 @@ model_dict = {
     "chat": DEEPSEEK_R1,
 }
 
+# Latency budget (seconds) of a query in each mode
+DEADLINES = {
+    "speed": 60,
+    "quality": 180,
+}
+# Part of the budget kept for the final LLM call
+LLM_TIME_RESERVE = {
+    "speed": 30,
+    "quality": 90,
+}
+REWRITE_TIMEOUT = 10  # part of the budget the query rewrite may use
+EMBEDDING_TIME_RESERVE = 10  # part of the quality mode crawl budget kept for embedding the crawled pages
+
 # Telegram
 TELEGRAM_TOKEN = ""
 CHAT_ID = ""
@@ -16,9 +29,19 @@ CHAT_ID = ""
 # Daily query
 DAILY_QUERY_TXT = "daily_query.txt"
 SCHEDULED_TIME = [9, 0, 0]
+DAILY_STATE_JSON = "daily_state.json"  # sources and summaries of previous runs, per topic
+DAILY_STATE_MAX_AGE_DAYS = 7  # forget sources not seen in the search results for this many days
+DAILY_SUMMARY_MAX_CHARS = 4000  # running summary of previous runs kept as LLM context, oldest runs are dropped first
 
 # SearXNG
 SEARCH_NUM_RESULTS = 50
 IP_ADDRESS = "http://localhost:8080"
 LANGUAGE = "zh"
 TIME_RANGE = "day"
+SEARCH_FIRST_PAGE_TIMEOUT = 10  # seconds, the first page is fetched even if the deadline has passed
+# Search the raw query while it is being rewritten, and reuse the results if the rewrite is close to it
+SPECULATIVE_SEARCH = True
+SPECULATIVE_SIM_THRESHOLD = 0.85  # query/rewrite similarity above which the results are merged
+
+# Crawler
+MAX_PAGE_CHARS = 20000  # crawled pages are truncated to this many characters
@@ -1,11 +1,13 @@
+import asyncio
 import requests
 import os
 import random
-from typing import List
+from typing import Dict, List, Optional
 
 from crawl4ai import AsyncWebCrawler, CrawlerRunConfig, CacheMode
 
-from utils import Document
+from utils import Document, Deadline
+from config import MAX_PAGE_CHARS
 
 
 # temporary patch for crawl4ai  --- start #
@@ -80,7 +82,7 @@ class Crawler:
                 f.write(response.text)
             return response.text.split('\n')
 
-    async def crawl_many(self, docs: List[Document]):
+    async def crawl_many(self, docs: List[Document], deadline: Optional[Deadline] = None):
         # filter urls by checking if the url contains any of the keys in self.elements_dict
         filtered_docs = [doc for doc in docs if any(key in doc.url for key in self.elements_dict) and doc.score > 0.5]
         print(f"Crawling {len(filtered_docs)} sources")
@@ -88,6 +90,19 @@ class Crawler:
             return
 
         url_to_doc = {doc.url: doc for doc in filtered_docs}
+        if deadline is None:
+            await self._crawl(url_to_doc)
+            return
+
+        try:
+            await asyncio.wait_for(self._crawl(url_to_doc), deadline.remaining())
+        except asyncio.TimeoutError:
+            # pages not crawled in time keep an empty content and fall back to their snippet
+            num_crawled = sum(1 for doc in filtered_docs if doc.content)
+            print(f"[TIMEOUT] Crawled {num_crawled}/{len(filtered_docs)} sources before the deadline")
+            deadline.mark_cut_short("crawl")
+
+    async def _crawl(self, url_to_doc: Dict[str, Document]):
         urls = list(url_to_doc.keys())
         async with AsyncWebCrawler(
             verbose=True,
@@ -100,6 +115,7 @@ class Crawler:
             ):
                 if result.success:
                     print(f"[SUCCESS] {result.url}")
-                    url_to_doc[result.url].content = result.markdown.raw_markdown
+                    # cap the page size at ingest, chunks only keep offsets into this string
+                    url_to_doc[result.url].content = result.markdown.raw_markdown[:MAX_PAGE_CHARS]
                 else:
                     print(f"[ERROR] {result.url} => {result.error_message}")
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from utils import Document
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def strip_citations(text: str) -> str:
+    # citation numbers only make sense for the sources of the run that produced them
+    return re.sub(r'\[citation:\d+\]', '', text)
+
+
+class DigestState:
+    """Persistent per-topic state for the daily digest.
+
+    Each topic keeps the sources it has already processed and a running summary of the previous runs,
+    made of the delta of each run:
+        {
+            "<topic>": {
+                "sources": {"<url>": {"snippet": "<sha1>", "content": "<sha1>", "last_seen": "YYYY-MM-DD"}},
+                "summaries": [{"date": "YYYY-MM-DD", "text": "<LLM answer of that run>"}],
+                "rewrite": "<rewritten query>",
+                "rewrite_date": "YYYY-MM-DD",
+            }
+        }
+
+    Changes are detected from the search result snippet: only sources whose URL is unseen or whose
+    snippet changed are crawled. A page whose body changed while its snippet stayed the same is not
+    crawled again, the content hash only filters out re-crawled pages that turned out unchanged.
+    """
+
+    def __init__(self, path: str, max_age_days: int = 7) -> None:
+        self.path = path
+        self.max_age_days = max_age_days
+        self.topics = self.load()
+
+    def load(self) -> Dict[str, dict]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.topics, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def get_topic(self, topic: str) -> dict:
+        topic_state = self.topics.setdefault(topic, {"sources": {}, "summaries": []})
+        self.prune(topic_state)
+        return topic_state
+
+    def prune(self, topic_state: dict) -> None:
+        # forget sources that have not shown up in the search results for a while
+        cutoff = (datetime.today() - timedelta(days=self.max_age_days)).strftime('%Y-%m-%d')
+        sources = topic_state["sources"]
+        for url in [url for url, info in sources.items() if info["last_seen"] < cutoff]:
+            del sources[url]
+
+    @staticmethod
+    def filter_new_by_snippet(topic_state: dict, docs: List[Document]) -> List[Document]:
+        """Return the documents whose URL is unseen or whose snippet has changed."""
+        sources = topic_state["sources"]
+        today = datetime.today().strftime('%Y-%m-%d')
+        new_docs = []
+        for doc in docs:
+            info = sources.get(doc.url)
+            if info is not None:
+                info["last_seen"] = today
+                if info["snippet"] == content_hash(doc.snippet):
+                    continue
+            new_docs.append(doc)
+        return new_docs
+
+    @staticmethod
+    def filter_new_by_content(topic_state: dict, docs: List[Document]) -> List[Document]:
+        """Drop crawled documents whose page content is identical to the last run."""
+        sources = topic_state["sources"]
+        new_docs = []
+        for doc in docs:
+            info = sources.get(doc.url)
+            if doc.content and info is not None and info.get("content") == content_hash(doc.content):
+                continue
+            new_docs.append(doc)
+        return new_docs
+
+    @staticmethod
+    def mark_seen(topic_state: dict, docs: List[Document]) -> None:
+        sources = topic_state["sources"]
+        today = datetime.today().strftime('%Y-%m-%d')
+        for doc in docs:
+            info = sources.setdefault(doc.url, {})
+            info["snippet"] = content_hash(doc.snippet)
+            if doc.content:
+                info["content"] = content_hash(doc.content)
+            info["last_seen"] = today
+
+    @staticmethod
+    def get_summary(topic_state: dict) -> str:
+        return "\n\n".join(f"[{entry['date']}]\n{entry['text']}" for entry in topic_state["summaries"])
+
+    @staticmethod
+    def append_summary(topic_state: dict, text: str, max_chars: int) -> None:
+        """Append the summary of this run, dropping the oldest runs beyond `max_chars`."""
+        summaries = topic_state["summaries"]
+        summaries.append({"date": datetime.today().strftime('%Y-%m-%d'), "text": strip_citations(text)})
+        # always keep the latest run, even if it is longer than the limit on its own
+        while len(summaries) > 1 and sum(len(entry["text"]) for entry in summaries) > max_chars:
+            summaries.pop(0)
@@ -1,51 +1,58 @@
 import asyncio
+import re
+from dataclasses import dataclass
 from os import environ
-from typing import List
+from typing import List, Optional, Tuple
 from datetime import datetime
 
+import numpy as np
+
 from agno.agent import Agent
 from agno.models.openai.like import OpenAILike
 from sentence_transformers import SentenceTransformer
 
-from utils import (search, FaissRetriever, Document, convert_to_telegram_markdown, 
+from utils import (search, FaissRetriever, Document, Deadline, convert_to_telegram_markdown, 
                    escape_special_chars, escape_special_chars_for_link)
 from retriever import expand_docs_by_text_split, merge_docs_by_url
-from config import OPENAI_LIKE_API_KEY, OPENAI_LIKE_BASE_URL, SEARCH_NUM_RESULTS, model_dict, LANGUAGE
+from config import (OPENAI_LIKE_API_KEY, OPENAI_LIKE_BASE_URL, SEARCH_NUM_RESULTS, model_dict, LANGUAGE,
+                    DAILY_SUMMARY_MAX_CHARS, DEADLINES, LLM_TIME_RESERVE, REWRITE_TIMEOUT,
+                    EMBEDDING_TIME_RESERVE, SPECULATIVE_SEARCH, SPECULATIVE_SIM_THRESHOLD)
 from crawl import Crawler
+from digest_state import DigestState
 
 environ['TOKENIZERS_PARALLELISM'] = "false"
 
 
+@dataclass(slots=True)
+class PrefetchedResults:
+    """Speculative search results of the raw query and their snippet embeddings."""
+    query: str
+    docs: List[Document]
+    embeddings: np.ndarray
+    merge_with_rewrite: bool = False
+    # the speculative search ran out of the rewrite budget before getting all the results
+    search_cut_short: bool = False
+
+
 class LLMSearch:
     def __init__(self):
-        self.rewriter = Agent(
-            model=OpenAILike(
-                id=model_dict["query_rewriter"],
-                api_key=OPENAI_LIKE_API_KEY,
-                base_url=OPENAI_LIKE_BASE_URL,
-            )
-        )
-
+        # model ids, an Agent is created per call in `create_agent`
+        self.rewriter = model_dict["query_rewriter"]
         self.chat = {
-            "speed": self.rewriter,
-            "quality": Agent(
-                model=OpenAILike(
-                    id=model_dict["chat"],
-                    api_key=OPENAI_LIKE_API_KEY,
-                    base_url=OPENAI_LIKE_BASE_URL,
-                )
-            )
+            "speed": model_dict["query_rewriter"],
+            "quality": model_dict["chat"],
         }
 
         self.max_sources = SEARCH_NUM_RESULTS
         self.embedding_model = SentenceTransformer("BAAI/bge-small-zh-v1.5", model_kwargs={"torch_dtype": "float16"})
         self.retriever = FaissRetriever(self.embedding_model)
         self.crawler = Crawler()
+        self.speculation_stats = {"used": 0, "merged": 0, "cancelled": 0, "fallback": 0}
     
     def get_today_date(self) -> str:
         return datetime.today().strftime('%Y-%m-%d')
     
-    def format_prompt(self, search_results: str, question: str, cur_date: str) -> str:
+    def format_prompt(self, search_results: str, question: str, cur_date: str, previous_summary: str = "") -> str:
         search_answer_zh_template = \
         f'''# 以下内容是基于用户发送的消息的搜索结果:
         {search_results}
@@ -63,6 +70,14 @@ class LLMSearch:
 
         # 用户消息为：
         {question}'''
+        if previous_summary:
+            previous_summary_template = \
+            f'''# 以下是之前几次的摘要，下面的搜索结果只包含此后新增或有更新的网页:
+        {previous_summary}
+        请重点总结相对于之前摘要的新进展，不要重复之前摘要中已有的内容。
+
+        '''
+            search_answer_zh_template = previous_summary_template + search_answer_zh_template
         return search_answer_zh_template
     
     def format_sources(self, sources: List[str]) -> str:
@@ -70,7 +85,7 @@ class LLMSearch:
             f"[webpage {i+1} begin]{source}[webpage {i+1} end]" for i, source in enumerate(sources)])
         return sources_str
     
-    def format_llm_response(self, llm_ans: str, docs: List[Document]) -> str:
+    def format_llm_response(self, llm_ans: str, docs: List[Document], cut_short: Optional[List[str]] = None) -> str:
         print(f'LLM Answer: \n{llm_ans}')
         llm_ans = convert_to_telegram_markdown(llm_ans)
         print(f'LLM Answer(converted): \n{llm_ans}')
@@ -89,19 +104,60 @@ class LLMSearch:
         # hide the citation part
         citation_str = '\n'.join([f'>{citation}' for citation in citations]) + '||'
         print(f'Citation: \n{citation_str}')
+        if cut_short:
+            cut_short_str = escape_special_chars(f"⏱ Cut short by the time limit: {', '.join(cut_short)}")
+            return f"{llm_ans}\n{cut_short_str}\n\n{citation_str}"
         return f"{llm_ans}\n\n{citation_str}"
 
-    def analyze_and_summarize(self, query: str, response: List[Document], mode: str = "speed") -> str:
+    def create_agent(self, model_id: str, timeout: Optional[float] = None) -> Agent:
+        # a new Agent per call: an Agent keeps the state of its current run, and a run that
+        # timed out may still be finishing in its worker thread
+        return Agent(
+            model=OpenAILike(
+                id=model_id,
+                api_key=OPENAI_LIKE_API_KEY,
+                base_url=OPENAI_LIKE_BASE_URL,
+                timeout=timeout,
+                # a retry would run past the deadline in the abandoned worker thread
+                max_retries=0 if timeout is not None else None,
+            )
+        )
+
+    async def run_agent(self, model_id: str, prompt: str, deadline: Optional[Deadline] = None,
+                        stage: str = "llm") -> Optional[str]:
+        """Run the model off the event loop. Returns None if the deadline is hit first."""
+        if deadline is None:
+            llm_res = await asyncio.to_thread(self.create_agent(model_id).run, prompt)
+            return llm_res.content
+
+        # the request timeout without retries lets the worker thread end soon after the deadline
+        timeout = deadline.remaining()
+        agent = self.create_agent(model_id, timeout=timeout)
+        try:
+            llm_res = await asyncio.wait_for(asyncio.to_thread(agent.run, prompt), timeout)
+        except asyncio.TimeoutError:
+            deadline.mark_cut_short(stage)
+            return None
+        return llm_res.content
+
+    async def summarize(self, query: str, response: List[Document], mode: str = "speed", previous_summary: str = "",
+                        deadline: Optional[Deadline] = None) -> Optional[str]:
         formatted_sources = self.format_sources(
             [data.content if data.content else data.snippet for data in response])
         cur_date = self.get_today_date()
-        prompt = self.format_prompt(formatted_sources, query, cur_date)
+        prompt = self.format_prompt(formatted_sources, query, cur_date, previous_summary)
         print(f'Prompt:\n {prompt}')
         
-        llm_res = self.chat[mode].run(prompt)
-        return self.format_llm_response(llm_res.content, response)
+        return await self.run_agent(self.chat[mode], prompt, deadline)
+
+    async def analyze_and_summarize(self, query: str, response: List[Document], mode: str = "speed",
+                                    deadline: Optional[Deadline] = None) -> str:
+        llm_ans = await self.summarize(query, response, mode, deadline=deadline)
+        if llm_ans is None:
+            llm_ans = "The answer could not be generated in time. Here are the most relevant sources."
+        return self.format_llm_response(llm_ans, response, deadline.cut_short if deadline else None)
     
-    def rewrite_query(self, query: str) -> str:
+    async def rewrite_query(self, query: str, deadline: Optional[Deadline] = None) -> str:
         # ref: https://github.com/langchain-ai/langchain/blob/master/cookbook/rewrite.ipynb?ref=blog.langchain.dev
         prompt = f"""
         今天是{self.get_today_date()}。
@@ -112,45 +168,209 @@ class LLMSearch:
 
         问题：{query} 回答：
         """
-        res = self.rewriter.run(prompt).content
+        res = await self.run_agent(self.rewriter, prompt, deadline, stage="rewrite")
+        if res is None:
+            # search with the original query rather than waiting for the rewrite
+            return query
         top_query = res.strip().replace('**', '')
         print(f'Original Query: {query}')
         print(f'Query Rewrite: {top_query}')
         return top_query
 
-    async def process_query(self, user_query: str, query_rewrite: str, mode: str = "speed"):
+    def normalize_query(self, query: str) -> str:
+        return re.sub(r'\s+', ' ', query).strip(' ?？。.!！').lower()
+
+    def merge_search_results(self, docs: List[Document], embeddings: np.ndarray, extra_docs: List[Document],
+                             max_docs: Optional[int] = None) -> Tuple[List[Document], np.ndarray]:
+        """Append the documents with unseen URLs, embedding only their snippets."""
+        seen_urls = {doc.url for doc in docs}
+        extra_docs = [doc for doc in extra_docs if doc.url not in seen_urls]
+        if max_docs is not None:
+            extra_docs = extra_docs[:max(0, max_docs - len(docs))]
+        if not extra_docs:
+            return docs, embeddings
+        extra_embeddings = self.retriever.encode_doc([doc.snippet for doc in extra_docs])
+        return docs + extra_docs, np.vstack([embeddings, extra_embeddings])
+
+    async def rewrite_query_speculative(self, query: str, deadline: Optional[Deadline] = None
+                                        ) -> Tuple[str, Optional[PrefetchedResults]]:
+        """Rewrite the query while speculatively searching the raw query.
+
+        The speculative results are used as they are if the rewrite is equivalent to the query
+        (or timed out), merged with the results of the rewrite in `process_query` if it is close
+        in embedding space, and dropped otherwise. A speculative search cut short by the rewrite
+        budget is continued in `process_query`.
+
+        Returns:
+            The rewritten query and the prefetched results for `process_query`, if any.
+        """
+        if not SPECULATIVE_SEARCH:
+            return await self.rewrite_query(query, deadline), None
+
+        # only the search runs in the worker thread, the embedding model is used on the event loop.
+        # the search gets its own copy of the deadline so that discarded results don't add a cut-short note
+        search_deadline = Deadline(deadline.remaining()) if deadline else None
+        speculative_task = asyncio.create_task(
+            asyncio.to_thread(search, query, self.max_sources, search_deadline))
+        try:
+            query_rewrite = await self.rewrite_query(query, deadline)
+        except Exception:
+            speculative_task.cancel()
+            raise
+
+        if deadline is not None and "rewrite" in deadline.cut_short:
+            # rewrite_query fell back to the raw query, the speculation didn't have to compete
+            outcome = "fallback"
+        elif self.normalize_query(query_rewrite) == self.normalize_query(query):
+            outcome = "used"
+        else:
+            query_embeddings = self.retriever.encode_doc([query, query_rewrite])
+            sim = float(np.dot(query_embeddings[0], query_embeddings[1]))
+            print(f"Query/rewrite similarity: {sim:.2f}")
+            outcome = "merged" if sim >= SPECULATIVE_SIM_THRESHOLD else "cancelled"
+
+        prefetched = None
+        if outcome == "cancelled":
+            # the worker thread can't be interrupted, its results are just discarded
+            speculative_task.cancel()
+        else:
+            try:
+                docs = await speculative_task
+            except Exception as e:
+                print(f"Speculative search failed: {e}")
+                docs = []
+
+            if not docs:
+                outcome = "cancelled"
+            else:
+                prefetched = PrefetchedResults(
+                    query=query,
+                    docs=docs,
+                    embeddings=self.retriever.encode_doc([doc.snippet for doc in docs]),
+                    merge_with_rewrite=outcome == "merged",
+                    search_cut_short="search" in search_deadline.cut_short if search_deadline else False,
+                )
+
+        self.speculation_stats[outcome] += 1
+        # only "used" and "fallback" skip the search after the rewrite, "merged" still waits for it
+        num_paid_off = self.speculation_stats["used"] + self.speculation_stats["fallback"]
+        num_total = sum(self.speculation_stats.values())
+        print(f"Speculative search {outcome}, saved the search latency in {num_paid_off}/{num_total} queries, "
+              f"merged in {self.speculation_stats['merged']} ({self.speculation_stats})")
+        return query_rewrite, prefetched
+
+    async def process_query(self, user_query: str, query_rewrite: str, mode: str = "speed",
+                            deadline: Optional[Deadline] = None,
+                            prefetched: Optional[PrefetchedResults] = None):
         """Process a search query and yield intermediate and final results.
+
+        `prefetched` holds speculative search results as returned by `rewrite_query_speculative`,
+        in which case `query_rewrite` is only searched if they have to be merged with its results.
+
+        With a deadline, the stages before the final LLM call leave `LLM_TIME_RESERVE[mode]` seconds
+        for it, and each stage returns what it has when its budget runs out. If there is no time left
+        to crawl, quality mode degrades to speed mode.
         
         Yields:
             int: First yield is the number of relevant documents
             str: Second yield is the final formatted response
         """
-        response = search(query_rewrite, self.max_sources)
-        self.retriever.add_documents(response)
+        stage_deadline = deadline.reserve(LLM_TIME_RESERVE[mode]) if deadline else None
+        if prefetched is not None:
+            response, embeddings = prefetched.docs, prefetched.embeddings
+            if prefetched.merge_with_rewrite:
+                rewrite_docs = search(query_rewrite, self.max_sources, stage_deadline)
+                response, embeddings = self.merge_search_results(response, embeddings, rewrite_docs)
+            elif prefetched.search_cut_short and len(response) < self.max_sources:
+                # continue the speculative search within the stage budget
+                more_docs = search(prefetched.query, self.max_sources, stage_deadline)
+                response, embeddings = self.merge_search_results(response, embeddings, more_docs, self.max_sources)
+            self.retriever.add_documents(response, embeddings=embeddings)
+        else:
+            response = search(query_rewrite, self.max_sources, stage_deadline)
+            self.retriever.add_documents(response, stage_deadline)
+
+        if not response:
+            yield 0
+            yield escape_special_chars("No sources were found for this query, please try again later.")
+            return
+
         relevant_docs = self.retriever.get_relevant_documents(user_query)
 
         yield len(relevant_docs)
 
+        if mode == "quality" and stage_deadline is not None and stage_deadline.expired():
+            # answer from the snippets with the faster model instead
+            deadline.mark_cut_short("crawl")
+            mode = "speed"
+
         if mode == "speed":
-            final_response = self.analyze_and_summarize(user_query, relevant_docs, mode)
+            final_response = await self.analyze_and_summarize(user_query, relevant_docs, mode, deadline)
             yield final_response
         elif mode == "quality":
-            await self.crawler.crawl_many(relevant_docs)
+            # leave time to embed the crawled pages before the stage deadline
+            crawl_deadline = stage_deadline.reserve(EMBEDDING_TIME_RESERVE) if stage_deadline else None
+            await self.crawler.crawl_many(relevant_docs, crawl_deadline)
             docs_w_details = expand_docs_by_text_split(relevant_docs)
 
-            self.retriever.add_documents(docs_w_details)
+            # documents that were not split (e.g. not crawled in time, answered from their snippet)
+            # go first and are always indexed, only the chunks of crawled pages can be cut short
+            unsplit_docs = [doc for doc in docs_w_details if isinstance(doc, Document)]
+            chunks = [doc for doc in docs_w_details if not isinstance(doc, Document)]
+            self.retriever.add_documents(unsplit_docs + chunks, stage_deadline, min_documents=len(unsplit_docs))
             relevant_docs_detailed = self.retriever.get_relevant_documents(user_query)
             relevant_docs_final = merge_docs_by_url(relevant_docs_detailed)
 
-            final_response = self.analyze_and_summarize(user_query, relevant_docs_final, mode)
+            final_response = await self.analyze_and_summarize(user_query, relevant_docs_final, mode, deadline)
             yield final_response
-            
+
+    async def process_daily_query(self, user_query: str, query_rewrite: str, topic_state: dict) -> Optional[str]:
+        """Run an incremental quality search for a daily digest topic.
+
+        Only sources that are new or changed since the last run are crawled and embedded,
+        and the LLM is asked for the delta against the previous summary.
+        `topic_state` is updated in place; the caller is responsible for persisting it.
+
+        Returns:
+            The formatted response, or None if nothing changed since the last run.
+        """
+        response = search(query_rewrite, self.max_sources)
+        new_docs = DigestState.filter_new_by_snippet(topic_state, response)
+        print(f"{len(new_docs)} of {len(response)} sources are new or changed")
+        if not new_docs:
+            return None
+
+        self.retriever.add_documents(new_docs)
+        relevant_docs = self.retriever.get_relevant_documents(user_query)
+
+        await self.crawler.crawl_many(relevant_docs)
+        changed_docs = DigestState.filter_new_by_content(topic_state, relevant_docs)
+        if not changed_docs:
+            DigestState.mark_seen(topic_state, new_docs)
+            return None
+
+        docs_w_details = expand_docs_by_text_split(changed_docs)
+        self.retriever.add_documents(docs_w_details)
+        relevant_docs_detailed = self.retriever.get_relevant_documents(user_query)
+        relevant_docs_final = merge_docs_by_url(relevant_docs_detailed)
+        if not relevant_docs_final:
+            DigestState.mark_seen(topic_state, new_docs)
+            return None
+
+        llm_ans = await self.summarize(user_query, relevant_docs_final, "quality", DigestState.get_summary(topic_state))
+        # mark every new or changed search hit as seen, including the ones the retriever found irrelevant,
+        # but only once the run succeeded
+        DigestState.mark_seen(topic_state, new_docs)
+        DigestState.append_summary(topic_state, llm_ans, DAILY_SUMMARY_MAX_CHARS)
+        return self.format_llm_response(llm_ans, relevant_docs_final)
+
 
 async def demo():
     agent = LLMSearch()
     query = "英伟达今日股价走势" if LANGUAGE == "zh" else "NVIDIA stock news today"
-    query_rewrite = agent.rewrite_query(query)
-    ans = agent.process_query(query, query_rewrite, mode="speed")
+    deadline = Deadline(DEADLINES["speed"])
+    query_rewrite, prefetched = await agent.rewrite_query_speculative(query, deadline.limit(REWRITE_TIMEOUT))
+    ans = agent.process_query(query, query_rewrite, mode="speed", deadline=deadline, prefetched=prefetched)
     doc_count = await anext(ans)
     print(f"Found {doc_count} relevant sources")
     final_response = await anext(ans)
@@ -2,40 +2,45 @@ from typing import List
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from utils import Document
+from utils import Document, DocumentChunk
 
 
-def expand_docs_by_text_split(docs: List[Document]) -> List[Document]:
+def expand_docs_by_text_split(docs: List[Document]) -> List[Document | DocumentChunk]:
+    """Split long documents into chunks that reference the original content by offset."""
     res_docs = []
 
+    chunk_overlap = 50  # chunk overlap (characters)
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=500,  # chunk size (characters)
-        chunk_overlap=50,  # chunk overlap (characters)
-        add_start_index=True,  # track index in original document
+        chunk_overlap=chunk_overlap,
     )
     for doc in docs:
         if len(doc.content) > 100:
-            all_splits = text_splitter.split_text(doc.content)
-            for split in all_splits:
-                res_docs.append(Document(
-                    title=doc.title,
-                    url=doc.url,
-                    snippet=doc.snippet,
-                    content=split,
-                ))
+            # same offset tracking as `add_start_index`, without keeping the split strings around
+            offset = 0
+            prev_len = 0
+            for split in text_splitter.split_text(doc.content):
+                search_from = max(0, offset + prev_len - chunk_overlap)
+                start = doc.content.find(split, search_from)
+                if start == -1:
+                    start = doc.content.find(split)
+                offset = start
+                prev_len = len(split)
+                res_docs.append(DocumentChunk(doc=doc, spans=[(start, start + prev_len)]))
         else:
             res_docs.append(doc)
     return res_docs
 
 
-def merge_docs_by_url(docs: List[Document]) -> List[Document]:
-    """Merge documents with the same URL by combining their snippets.
+def merge_docs_by_url(docs: List[Document | DocumentChunk]) -> List[Document | DocumentChunk]:
+    """Merge documents with the same URL by combining their content.
     
     Args:
-        docs: List of Document objects
+        docs: List of Document or DocumentChunk objects
         
     Returns:
-        List of Document objects with merged snippets for documents with the same URL
+        List of documents where the chunks of each URL are merged into a single DocumentChunk,
+        with overlapping spans coalesced so the shared text only appears once
     """
     url_to_docs = {}
     
@@ -49,22 +54,35 @@ def merge_docs_by_url(docs: List[Document]) -> List[Document]:
     
     # Merge documents with the same URL
     for doc_list in url_to_docs.values():
+        base_doc = doc_list[0]
         if len(doc_list) == 1:
             # No need to merge if there's only one document with this URL
-            merged_docs.append(doc_list[0])
-        else:
-            # Get the first document as the base
-            base_doc = doc_list[0]
-            
-            # Combine snippets from all documents with the same URL
-            combined_content = "\n".join([d.content for d in doc_list])
-            
-            # Create a new document with the combined snippet
-            merged_doc = Document(
+            merged_docs.append(base_doc)
+        elif not all(isinstance(d, DocumentChunk) and d.doc is base_doc.doc for d in doc_list):
+            # e.g. the search engine returned the same URL twice
+            merged_docs.append(Document(
                 title=base_doc.title,
                 url=base_doc.url,
                 snippet=base_doc.snippet,
-                content=combined_content
+                content="\n".join([d.content for d in doc_list]),
+                score=max(d.score for d in doc_list),
+            ))
+        else:
+            # Chunks of the same page are merged as spans over the stored page content
+            spans = sorted(span for d in doc_list for span in d.spans)
+
+            merged_spans = [spans[0]]
+            for start, end in spans[1:]:
+                prev_start, prev_end = merged_spans[-1]
+                if start <= prev_end:
+                    merged_spans[-1] = (prev_start, max(prev_end, end))
+                else:
+                    merged_spans.append((start, end))
+
+            merged_doc = DocumentChunk(
+                doc=base_doc.doc,
+                spans=merged_spans,
+                score=max(d.score for d in doc_list),
             )
             
             merged_docs.append(merged_doc)
@@ -7,8 +7,10 @@ from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
 from llm_search import LLMSearch
-from config import TELEGRAM_TOKEN, CHAT_ID, DAILY_QUERY_TXT, SCHEDULED_TIME
-from utils import escape_special_chars
+from config import (TELEGRAM_TOKEN, CHAT_ID, DAILY_QUERY_TXT, SCHEDULED_TIME, DAILY_STATE_JSON, DAILY_STATE_MAX_AGE_DAYS,
+                    DEADLINES, REWRITE_TIMEOUT)
+from utils import escape_special_chars, Deadline
+from digest_state import DigestState
 
 
 # Enable logging
@@ -20,6 +22,7 @@ logger = logging.getLogger(__name__)
 
 # Initialize the LLMSearch instance
 search_engine = LLMSearch()
+digest_state = DigestState(DAILY_STATE_JSON, DAILY_STATE_MAX_AGE_DAYS)
 
 
 # Telegram bot command handlers
@@ -69,10 +72,13 @@ async def perform_search(update: Update, query: str, mode: str = "speed") -> Non
     await update.message.reply_text(f"{cur_text} Using {mode_emoji} {mode} mode.")
     
     try:
-        query_rewrite = search_engine.rewrite_query(query)
+        deadline = Deadline(DEADLINES[mode])
+        query_rewrite, prefetched = await search_engine.rewrite_query_speculative(
+            query, deadline.limit(REWRITE_TIMEOUT))
         await update.message.reply_text(f'🔍 Searching for "{query_rewrite}"...')
 
-        results_generator = search_engine.process_query(query, query_rewrite, mode=mode)
+        results_generator = search_engine.process_query(
+            query, query_rewrite, mode=mode, deadline=deadline, prefetched=prefetched)
 
         doc_count = await anext(results_generator)
         await update.message.reply_text(f"Found {doc_count} relevant sources. Analyzing...")
@@ -107,15 +113,22 @@ async def daily_news(context: ContextTypes.DEFAULT_TYPE) -> None:
 
         for query in query_list:
             query = query.strip()
-            query_rewrite = search_engine.rewrite_query(query)
-            results_generator = search_engine.process_query(query, query_rewrite, mode="quality")
+            if not query:
+                continue
+            topic_state = digest_state.get_topic(query)
 
-            doc_count = await anext(results_generator)
-            logger.info(f"Found {doc_count} relevant sources for {query}")
+            # the rewrite depends on the date only, so reuse it for intraday runs
+            current_date = datetime.now().strftime("%Y-%m-%d")
+            if topic_state.get("rewrite_date") != current_date:
+                topic_state["rewrite"] = await search_engine.rewrite_query(query)
+                topic_state["rewrite_date"] = current_date
 
-            response = await anext(results_generator)
+            response = await search_engine.process_daily_query(query, topic_state["rewrite"], topic_state)
+            digest_state.save()
+            if response is None:
+                logger.info(f"No new sources for {query}, skipping")
+                continue
 
-            current_date = datetime.now().strftime("%Y-%m-%d")
             title = f'📰 Daily Update ({current_date}) for "{query}"'
             title = escape_special_chars(title)
 
@@ -2,16 +2,17 @@ from dataclasses import dataclass
 import urllib.parse
 from json import JSONDecodeError
 import requests
-from typing import List
+from typing import List, Optional, Tuple
 import re
+import time
 
 import faiss
 import numpy as np
 
-from config import IP_ADDRESS, LANGUAGE, TIME_RANGE
+from config import IP_ADDRESS, LANGUAGE, TIME_RANGE, SEARCH_FIRST_PAGE_TIMEOUT
 
 
-@dataclass
+@dataclass(slots=True)
 class Document:
     title: str = ""
     url: str = ""
@@ -19,6 +20,65 @@ class Document:
     content: str = ""
     score: float = 0.0
 
+
+@dataclass(slots=True)
+class DocumentChunk:
+    """A view into the content of a Document, stored as (start, end) offsets instead of a copy.
+
+    Spans are sorted and non-overlapping; a chunk merged from several splits of the
+    same page has one span per contiguous region.
+    """
+    doc: Document
+    spans: List[Tuple[int, int]]
+    score: float = 0.0
+
+    @property
+    def title(self) -> str:
+        return self.doc.title
+
+    @property
+    def url(self) -> str:
+        return self.doc.url
+
+    @property
+    def snippet(self) -> str:
+        return self.doc.snippet
+
+    @property
+    def content(self) -> str:
+        return "\n".join(self.doc.content[start:end] for start, end in self.spans)
+
+
+class Deadline:
+    """Latency budget of a request, passed down through its stages.
+
+    Stages that run out of budget return what they have and record themselves in `cut_short`.
+    """
+
+    def __init__(self, seconds: float, cut_short: Optional[List[str]] = None) -> None:
+        self.expires_at = time.monotonic() + seconds
+        self.cut_short = cut_short if cut_short is not None else []
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def reserve(self, seconds: float) -> "Deadline":
+        """Return an earlier deadline that leaves `seconds` for the stages after it."""
+        return Deadline(self.remaining() - seconds, self.cut_short)
+
+    def limit(self, seconds: float) -> "Deadline":
+        """Return a deadline for a stage that may use at most `seconds` of the budget."""
+        return Deadline(min(seconds, self.remaining()), self.cut_short)
+
+    def mark_cut_short(self, stage: str) -> None:
+        print(f"[DEADLINE] {stage} was cut short")
+        if stage not in self.cut_short:
+            self.cut_short.append(stage)
+
+
 def encode_url(url: str) -> str:
     return urllib.parse.quote(url)
 
@@ -98,7 +158,7 @@ def convert_to_telegram_markdown(text):
     return ''.join(result)
 
 
-def search(query: str, num_results: int) -> List[Document]:
+def search(query: str, num_results: int, deadline: Optional[Deadline] = None) -> List[Document]:
     headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0",
                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
                "Accept-Language": "en-US,en;q=0.5"}
@@ -108,8 +168,25 @@ def search(query: str, num_results: int) -> List[Document]:
     base_url = IP_ADDRESS
     res = []
     while len(res) < num_results:
+        timeout = None
+        if deadline is not None:
+            timeout = deadline.remaining()
+            if pageno == 1:
+                # always try to get the first page, there is nothing to answer from otherwise
+                timeout = max(timeout, SEARCH_FIRST_PAGE_TIMEOUT)
+            elif timeout <= 0:
+                deadline.mark_cut_short("search")
+                break
+
         url = base_url + request_str + str(pageno)
-        response = requests.get(url, headers=headers)
+        try:
+            response = requests.get(url, headers=headers, timeout=timeout)
+        except requests.exceptions.Timeout:
+            if deadline is None:
+                raise
+            # keep the results of the pages fetched so far
+            deadline.mark_cut_short("search")
+            break
 
         try:
             response_dict = response.json()
@@ -134,10 +211,12 @@ def search(query: str, num_results: int) -> List[Document]:
 
 
 class FaissRetriever:
-    def __init__(self, embedding_model, num_candidates: int = 40, sim_threshold: float = 0.45) -> None:
+    def __init__(self, embedding_model, num_candidates: int = 40, sim_threshold: float = 0.45,
+                 batch_size: int = 64) -> None:
         self.embedding_model = embedding_model
         self.num_candidates = num_candidates
         self.sim_threshold = sim_threshold
+        self.batch_size = batch_size
         self.embeddings_dim = embedding_model.get_sentence_embedding_dimension()
         self.reset_state()
     
@@ -148,16 +227,38 @@ class FaissRetriever:
     def encode_doc(self, doc: str | List[str]) -> np.ndarray:
         return self.embedding_model.encode(doc, normalize_embeddings=True)
 
-    def add_documents(self, documents: List[Document]) -> None:
+    def add_documents(self, documents: List[Document], deadline: Optional[Deadline] = None,
+                      embeddings: Optional[np.ndarray] = None, min_documents: int = 0) -> None:
         if not documents:
             print('No documents added to the retriever')
+            # don't answer from the documents of the previous query
+            self.reset_state()
             return
         
         self.reset_state()
-        self.documents = documents
-        doc_embeddings = self.encode_doc(
-            [doc.content if doc.content else doc.snippet for doc in documents])
-        self.index.add(doc_embeddings)
+        if embeddings is not None:
+            # already encoded, e.g. by a speculative search
+            self.documents = documents
+            self.index.add(embeddings)
+            return
+
+        texts = [doc.content if doc.content else doc.snippet for doc in documents]
+        if deadline is None:
+            self.documents = documents
+            self.index.add(self.encode_doc(texts))
+            return
+
+        # encode in batches so that we can stop at the deadline,
+        # the first batch and the first `min_documents` documents are always indexed
+        num_encoded = 0
+        while num_encoded < len(texts):
+            if num_encoded and num_encoded >= min_documents and deadline.expired():
+                deadline.mark_cut_short("embedding")
+                break
+            batch = texts[num_encoded:num_encoded + self.batch_size]
+            self.index.add(self.encode_doc(batch))
+            num_encoded += len(batch)
+        self.documents = documents[:num_encoded]
     
     def filter_by_sim(self, distances: np.ndarray, indices: np.ndarray) -> np.ndarray:
         cutoff_idx = -1